@@ -1,21 +1,28 @@
 #!/usr/bin/env python3
 import argparse
-import base64
-import json
+import hashlib
 import logging
 import os
 import secrets
-from collections import defaultdict
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from pathlib import Path
 
 import bcrypt
+import orjson
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from onepasswordconnectsdk.client import new_client_from_environment
 
+# Default bcrypt cost for the ArgoCD admin password hash; override it with
+# the "argocd.bcrypt_cost" installer secret.
+DEFAULT_BCRYPT_COST = 12
+
+# Number of concurrent requests used to fetch items from 1Password.
+OP_FETCH_WORKERS = 16
+
 
 class SecretGenerator:
     """A basic secret generator that manages a secrets directory containing
@@ -32,7 +39,8 @@ class SecretGenerator:
     """
 
     def __init__(self, environment, regenerate):
-        self.secrets = defaultdict(dict)
+        self.secrets = {}
+        self._loaded_hashes = {}
         self.environment = environment
         self.regenerate = regenerate
 
@@ -45,7 +53,7 @@ class SecretGenerator:
         self._argocd()
 
         self.input_field("cert-manager", "enabled", "Use cert-manager? (y/n):")
-        use_cert_manager = self.secrets["cert-manager"]["enabled"]
+        use_cert_manager = self._get_current("cert-manager", "enabled")
         if use_cert_manager == "y":
             self._cert_manager()
         elif use_cert_manager == "n":
@@ -62,31 +70,77 @@ class SecretGenerator:
         This method parses the JSON files and persists them in the ``secrets``
         attribute, keyed by the component name.
         """
-        if Path("secrets").is_dir():
-            for f in Path("secrets").iterdir():
-                print(f"Loading {f}")
-                component = os.path.basename(f)
-                self.secrets[component] = json.loads(f.read_text())
+        if not os.path.isdir("secrets"):
+            return
+
+        with os.scandir("secrets") as entries:
+            for entry in entries:
+                # Skip temporary files left behind by an interrupted save().
+                if entry.name.startswith("."):
+                    continue
+                print(f"Loading {entry.path}")
+                with open(entry.path, "rb") as f:
+                    data = f.read()
+                self.secrets[entry.name] = orjson.loads(data)
+                self._loaded_hashes[entry.name] = self._hash(data)
 
     def save(self):
         """For each component, save a secret JSON file into the secrets
-        directory.
+        directory. New components with no secrets, and components whose
+        secrets are unchanged since `load`, are skipped.
         """
         os.makedirs("secrets", exist_ok=True)
 
-        for k, v in self.secrets.items():
-            with open(f"secrets/{k}", "w") as f:
-                f.write(json.dumps(v))
+        # A component loaded from disk is still written when it is now empty,
+        # so that removed secrets don't linger in its file.
+        components = [
+            (k, v)
+            for k, v in self.secrets.items()
+            if v or k in self._loaded_hashes
+        ]
+        serialized = [(k, orjson.dumps(v)) for k, v in components]
+        payloads = [
+            (k, data)
+            for k, data in serialized
+            if self._loaded_hashes.get(k) != self._hash(data)
+        ]
+        with ThreadPoolExecutor() as executor:
+            # list() so that any write error is raised here.
+            list(executor.map(lambda p: self._write_secret_file(*p), payloads))
+
+    @staticmethod
+    def _hash(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    @staticmethod
+    def _write_secret_file(component, data):
+        """Atomically replace ``secrets/<component>`` with ``data``.
+
+        The data is written to a hidden temporary file in the same directory
+        and renamed into place once it is on disk, so an interrupted run or a
+        crash never leaves a truncated secrets file behind. The file is only
+        readable by its owner (mode 0600).
+        """
+        fd, tmp_path = tempfile.mkstemp(dir="secrets", prefix=f".{component}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join("secrets", component))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
     def input_field(self, component, name, description):
-        default = self.secrets[component].get(name, "")
+        default = self.secrets.get(component, {}).get(name, "")
         prompt_string = (
             f"[{component} {name}] ({description}): [current: {default}] "
         )
         input_string = input(prompt_string)
 
         if input_string:
-            self.secrets[component][name] = input_string
+            self._set(component, name, input_string)
 
     def input_file(self, component, name, description):
         current = self.secrets.get(component, {}).get(name, "")
@@ -95,33 +149,46 @@ class SecretGenerator:
         prompt_string = "New filename with contents (empty to not change): "
         fname = input(prompt_string)
 
-        print(f"{self.secrets[component]}")
+        print(f"{self.secrets.get(component, {})}")
         if fname:
             with open(fname, "r") as f:
-                self.secrets[component][name] = f.read()
+                self._set(component, name, f.read())
 
     @staticmethod
     def _generate_gafaelfawr_token() -> str:
-        key = base64.urlsafe_b64encode(os.urandom(16)).decode().rstrip("=")
-        secret = base64.urlsafe_b64encode(os.urandom(16)).decode().rstrip("=")
-        return f"gt-{key}.{secret}"
+        return f"gt-{secrets.token_urlsafe(16)}.{secrets.token_urlsafe(16)}"
 
     def _get_current(self, component, name):
-        if not self._exists(component, name):
+        bucket = self.secrets.get(component)
+        if bucket is None:
             return None
 
-        return self.secrets[component][name]
+        return bucket.get(name)
 
     def _set(self, component, name, new_value):
-        self.secrets[component][name] = new_value
+        self.secrets.setdefault(component, {})[name] = new_value
 
     def _exists(self, component, name):
-        return component in self.secrets and name in self.secrets[component]
+        bucket = self.secrets.get(component)
+        return bucket is not None and name in bucket
 
     def _set_generated(self, component, name, new_value):
-        if not self._exists(component, name) or self.regenerate:
-            self._set(component, name, new_value)
+        bucket = self.secrets.setdefault(component, {})
+        if name not in bucket or self.regenerate:
+            bucket[name] = new_value
 
+    @staticmethod
+    def _bcrypt_cost(hashed):
+        """Return the cost factor encoded in a ``$2b$NN$...`` bcrypt hash,
+        or `None` if the hash is not in a recognized format.
+        """
+        parts = hashed.split("$")
+        if len(parts) < 4 or parts[1] not in {"2a", "2b", "2y"}:
+            return None
+        try:
+            return int(parts[2])
+        except ValueError:
+            return None
 
     def _pull_secret(self):
         self.input_file(
@@ -144,11 +211,35 @@ class SecretGenerator:
             "argocd.admin.plaintext_password",
             "Admin password for ArgoCD?",
         )
-        new_pw = self.secrets["installer"]["argocd.admin.plaintext_password"]
+        new_pw = self._get_current(
+            "installer", "argocd.admin.plaintext_password"
+        )
+
+        cost = int(
+            self.secrets.get("installer", {}).get(
+                "argocd.bcrypt_cost", DEFAULT_BCRYPT_COST
+            )
+        )
+        current_hash = self._get_current("argocd", "admin.password")
+
+        # Rehashing with a new salt buys nothing if the password is the same
+        # and the existing hash already uses the configured cost, so
+        # --regenerate only forces a rehash when the cost has changed. Only
+        # the hash is kept, so an entered password is checked against it to
+        # decide whether the password changed.
+        rehash = (
+            current_hash is None or self._bcrypt_cost(current_hash) != cost
+        )
+        if not rehash and new_pw is not None and current_pw != new_pw:
+            rehash = not bcrypt.checkpw(
+                new_pw.encode("ascii"), current_hash.encode("ascii")
+            )
 
-        if current_pw != new_pw or self.regenerate:
+        if rehash:
+            if new_pw is None:
+                raise Exception("ArgoCD admin password required to rehash")
             h = bcrypt.hashpw(
-                new_pw.encode("ascii"), bcrypt.gensalt(rounds=15)
+                new_pw.encode("ascii"), bcrypt.gensalt(rounds=cost)
             ).decode("ascii")
             now_time = datetime.now(timezone.utc).strftime(
                 "%Y-%m-%dT%H:%M:%SZ"
@@ -157,6 +248,10 @@ class SecretGenerator:
             self._set("argocd", "admin.password", h)
             self._set("argocd", "admin.passwordMtime", now_time)
 
+        self.secrets.get("installer", {}).pop(
+            "argocd.admin.plaintext_password", None
+        )
+
         self.input_field(
             "argocd",
             "dex.clientSecret",
@@ -167,6 +262,44 @@ class SecretGenerator:
             "argocd", "server.secretkey", secrets.token_hex(16)
         )
 
+
+class _ItemFields:
+    """The fields of a 1Password item that `OnePasswordSecretGenerator`
+    uses, collected while scanning the item's fields.
+    """
+
+    __slots__ = ("key", "notes", "password", "environments")
+
+    def __init__(self):
+        self.key = None
+        self.notes = None
+        self.password = None
+        self.environments = []
+
+
+def _set_key(fields, value):
+    if fields.key is not None:
+        raise Exception(f"Found two generate_secrets_keys for {fields.key}")
+    fields.key = value
+
+
+def _append_env(fields, value):
+    fields.environments.append(value)
+
+
+def _set_notes(fields, value):
+    fields.notes = value
+
+
+# Handlers for 1Password item fields, keyed by field label. Fields with
+# other labels are only used if they are the item's password.
+_LABEL_ACTIONS = {
+    "generate_secrets_key": _set_key,
+    "environment": _append_env,
+    "notesPlain": _set_notes,
+}
+
+
 class OnePasswordSecretGenerator(SecretGenerator):
     """A secret generator that syncs 1Password secrets into a secrets directory
     containing per-component secret export files from Vault (as generated
@@ -189,7 +322,8 @@ class OnePasswordSecretGenerator(SecretGenerator):
 
     def parse_vault(self):
         """Parse the 1Password vault and store secrets applicable to this
-        environment in the `op_secrets` attribute.
+        environment in the `op_secrets` attribute, keyed by
+        ``(component, name)``.
 
         This method is called automatically when initializing a
         `OnePasswordSecretGenerator`.
@@ -197,33 +331,32 @@ class OnePasswordSecretGenerator(SecretGenerator):
         vault = self.op.get_vault_by_title("RSP-Vault")
         items = self.op.get_items(vault.id)
 
-        for item_summary in items:
-            key = None
-            secret_notes = None
-            secret_password = None
-            environments = []
-            item = self.op.get_item(item_summary.id, vault.id)
+        # Fetch the full items concurrently; each fetch is a separate HTTP
+        # round trip. map() preserves the vault order, which matters for
+        # which all-environment item wins below.
+        with ThreadPoolExecutor(max_workers=OP_FETCH_WORKERS) as executor:
+            fetched = executor.map(
+                lambda summary: self.op.get_item(summary.id, vault.id), items
+            )
+
+        for item in fetched:
+            fields = _ItemFields()
 
-            logging.debug(f"Looking at {item.id}")
+            logging.debug("Looking at %s", item.id)
 
             for field in item.fields:
-                if field.label == "generate_secrets_key":
-                    if key is None:
-                        key = field.value
-                    else:
-                        msg = "Found two generate_secrets_keys for {key}"
-                        raise Exception(msg)
-                elif field.label == "environment":
-                    environments.append(field.value)
-                elif field.label == "notesPlain":
-                    secret_notes = field.value
+                action = _LABEL_ACTIONS.get(field.label)
+                if action:
+                    action(fields, field.value)
                 elif field.purpose == "PASSWORD":
-                    secret_password = field.value
+                    fields.password = field.value
 
+            key = tuple(fields.key.split()) if fields.key else None
+            environments = fields.environments
             if not key:
                 continue
 
-            secret_value = secret_notes or secret_password
+            secret_value = fields.notes or fields.password
 
             if not secret_value:
                 logging.error("No value found for %s", item.title)
@@ -246,11 +379,13 @@ class OnePasswordSecretGenerator(SecretGenerator):
         This method overrides `SecretGenerator.input_field`, which prompts
         a user interactively.
         """
-        key = f"{component} {name}"
+        key = (component, name)
         if key not in self.op_secrets:
-            raise Exception(f"Did not find entry in 1Password for {key}")
+            raise Exception(
+                f"Did not find entry in 1Password for {component} {name}"
+            )
 
-        self.secrets[component][name] = self.op_secrets[key]
+        self._set(component, name, self.op_secrets[key])
 
     def input_file(self, component, name, description):
         """Query for a secret file from 1Password (`op_secrets` attribute).
@@ -272,18 +407,22 @@ class OnePasswordSecretGenerator(SecretGenerator):
         """
         super().generate()
 
-        for composite_key, secret_value in self.op_secrets.items():
-            item_component, item_name = composite_key.split()
+        for key, secret_value in self.op_secrets.items():
+            item_component, item_name = key
             # Special case for components that may not be present in every
             # environment, but nonetheless might be 1Password secrets (see
             # conditional in SecretGenerator.generate)
             if item_component in {"ingress-nginx", "cert-manager"}:
                 continue
+            # The ArgoCD plaintext password is only used to compute the hash
+            # in SecretGenerator._argocd and must not be saved.
+            if key == ("installer", "argocd.admin.plaintext_password"):
+                continue
 
             logging.debug(
                 "Updating component: %s/%s", item_component, item_name
             )
-            self.input_field(item_component, item_name, "")
+            self._set(item_component, item_name, secret_value)
 
 
 if __name__ == "__main__":